@@ -1,12 +1,23 @@
+import asyncio
 import logging
+import sys
 
 from automirror.main import main
 
+try:
+    # 可选依赖，安装后使用libuv实现的事件循环，Windows上对应的是winloop
+    if sys.platform == 'win32':
+        import winloop as uvloop
+    else:
+        import uvloop
+except ImportError:
+    uvloop = None
+
 
 def entry():
-    import asyncio, sys
     logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
     try:
-        asyncio.run(main(sys.argv[1:]))
+        with asyncio.Runner(loop_factory=uvloop.new_event_loop if uvloop else None) as runner:
+            runner.run(main(sys.argv[1:]))
     except Exception as e:
         logging.error(e)
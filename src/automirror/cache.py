@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+import os
+from pathlib import Path
+
+
+def default_cache_dir() -> Path:
+    return Path(os.environ.get('XDG_CACHE_HOME') or Path.home() / '.cache') / 'automirror'
+
+
+class HttpCache:
+    """
+    按URL保存列表请求的ETag/Last-Modified和解析后的内容，跨运行复用
+
+    请求时带上If-None-Match/If-Modified-Since，服务端返回304时直接使用缓存的内容，
+    GitHub的304响应不计入速率限制；完整同步后保存时只保留本次运行用到的条目
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.entries: dict[str, dict] = {}
+        self.used: set[str] = set()
+
+    def load(self):
+        try:
+            self.entries = json.loads(self.path.read_bytes())
+        except FileNotFoundError:
+            self.entries = {}
+        except (OSError, ValueError) as e:
+            logging.warning('读取缓存%s失败，将忽略缓存 %s', self.path, e)
+            self.entries = {}
+
+    def save(self, prune: bool = True):
+        entries = self.entries
+        if prune:
+            entries = {url: entries[url] for url in self.used if url in entries}
+        tmp_path = self.path.with_suffix('.tmp')
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path.write_text(json.dumps(entries, ensure_ascii=False), encoding='utf-8')
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logging.warning('写入缓存%s失败 %s', self.path, e)
+
+    def get(self, url: str) -> dict | None:
+        self.used.add(url)
+        return self.entries.get(url)
+
+    def set(self, url: str, entry: dict):
+        self.used.add(url)
+        self.entries[url] = entry
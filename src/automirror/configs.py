@@ -1,12 +1,36 @@
 # -*- coding: utf-8 -*-
+from __future__ import annotations
+
 import asyncio
 import dataclasses
 import logging
-import token
+import re
+import tomllib
 from enum import StrEnum
 from pathlib import Path
-from urllib.parse import urlparse
-from httpx import AsyncClient
+from typing import TYPE_CHECKING
+from automirror.cache import HttpCache, default_cache_dir
+
+if TYPE_CHECKING:
+    from httpx import URL, AsyncClient
+
+
+def _require(condition, message: str):
+    # 不使用assert，python -O运行时assert会被去掉
+    if not condition:
+        raise ValueError(message)
+
+
+# httpx只在scheme为小写时去掉显式的默认端口，比较前自行补全
+_DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+
+def _url_origin(url: URL) -> tuple:
+    return url.scheme, url.host, url.port or _DEFAULT_PORTS.get(url.scheme)
+
+
+# scheme://netloc，与urlparse得到非空scheme和netloc等价
+_URL_RE = re.compile(r'^[a-zA-Z][a-zA-Z0-9+.\-]*://[^/?#\s]+')
 
 
 class MirrorType(StrEnum):
@@ -29,53 +53,113 @@ class Mirror:
 
     def validate(self) -> bool:
         if not self.origin:
-            logging.warning(f'{self}的名字为空，将跳过同步')
+            logging.warning('%s的名字为空，将跳过同步', self)
             return False
         if not self.target:
             self.target = self.origin
         if self.type not in MirrorType:
-            logging.warning(f'{self}的类型不在可选范围，将跳过同步')
+            logging.warning('%s的类型不在可选范围，将跳过同步', self)
             return False
         self.type = MirrorType(self.type)
         if self.type == MirrorType.REPO:
             if not self.url:
-                logging.warning(f'{self}的clone_url为空，将跳过同步')
+                logging.warning('%s的clone_url为空，将跳过同步', self)
                 return False
-            parsed = urlparse(self.url)
-            if not bool(parsed.scheme and parsed.netloc):
-                logging.warning(f'{self}的clone_url不合法，将跳过同步')
+            if not _URL_RE.match(self.url):
+                logging.warning('%s的clone_url不合法，将跳过同步', self)
                 return False
         return True
 
 
+class DynamicLimiter:
+    """
+    可在运行时调整上限的并发限制器
+
+    asyncio.Semaphore 无法安全地修改上限，这里用 Condition 保护一个计数器，
+    调大上限时唤醒等待者，调小时不打断进行中的任务，等它们退出后自然收缩
+    """
+
+    def __init__(self, limit: int):
+        self.limit = self.max_limit = limit
+        self.active = 0
+        self._cond = asyncio.Condition()
+
+    async def __aenter__(self):
+        async with self._cond:
+            await self._cond.wait_for(lambda: self.active < self.limit)
+            self.active += 1
+
+    async def __aexit__(self, exc_type, exc, tb):
+        async with self._cond:
+            self.active -= 1
+            self._cond.notify(1)
+
+    async def set_limit(self, limit: int):
+        _require(limit >= 1, f'并发数至少为1, {limit=}')
+        async with self._cond:
+            self.limit = limit
+            self._cond.notify_all()
+
+
 class Session:
     target_base_url: str
     origin_base_url: str
+    # 固定不变的接口地址，加载配置时拼好
+    migrate_url: str
+    create_org_url: str
     token: str
+    # 规范化后的target_base_url，判断请求是否发往镜像站
+    target_url: URL
 
     mirrors: list[Mirror]
 
-    target_client: AsyncClient
-    origin_client: AsyncClient = AsyncClient(timeout=None)
-    semaphore: asyncio.Semaphore
+    # 源站和镜像站共用一个客户端，token只附加在发往镜像站的请求上
+    client: AsyncClient
+    concurrency: int
+    limiter: DynamicLimiter
+    delete_limiter: DynamicLimiter
+    mirror_limiter: asyncio.Semaphore
+
+    # target org -> 仓库名集合，同一次运行中每个target只列出一次
+    target_repo_cache: dict[str, set[str]]
+    target_repo_tasks: dict[str, asyncio.Task]
+    # target org -> 检查/创建org的任务
+    target_org_tasks: dict[str, asyncio.Task]
+
+    http_cache: HttpCache
 
     def load_config(self, config_path: Path):
         if not config_path.is_file():
             raise FileNotFoundError(f"没有找到配置文件 {config_path}")
-        with config_path.open('rb') as f:
-            import tomllib
-            raw_config = tomllib.load(f)
-        assert raw_config.get('config'), '配置文件中没有 config 项'
+        raw_config = tomllib.loads(config_path.read_bytes().decode('utf-8'))
+        _require(raw_config.get('config'), '配置文件中没有 config 项')
         self.target_base_url = raw_config['config'].get('target_base_url')
-        assert self.target_base_url, 'target_base_url未配置'
+        _require(self.target_base_url, 'target_base_url未配置')
         self.origin_base_url = raw_config['config'].get('origin_base_url')
-        assert self.origin_base_url, 'origin_base_url未配置'
+        _require(self.origin_base_url, 'origin_base_url未配置')
+        self.migrate_url = f'{self.target_base_url}/repos/migrate/'
+        self.create_org_url = f'{self.target_base_url}/orgs/'
         self.token = raw_config['config'].get('token')
-        assert self.token, '认证token未配置'
-        assert raw_config.get('mirrors'), '没有配置镜像列表'
-        concurrency = raw_config['config'].get('concurrency', 3)
-        assert concurrency >= 1, f'并发数至少为1, {concurrency=}'
-        self.semaphore = asyncio.Semaphore(concurrency)
+        _require(self.token, '认证token未配置')
+        _require(raw_config.get('mirrors'), '没有配置镜像列表')
+        self.concurrency = raw_config['config'].get('concurrency', 3)
+        _require(self.concurrency >= 1, f'并发数至少为1, {self.concurrency=}')
+        self.limiter = DynamicLimiter(self.concurrency)
+        delete_concurrency = raw_config['config'].get('delete_concurrency', 5)
+        _require(delete_concurrency >= 1, f'删除并发数至少为1, {delete_concurrency=}')
+        self.delete_limiter = DynamicLimiter(delete_concurrency)
+        mirror_concurrency = raw_config['config'].get('mirror_concurrency', 5)
+        _require(mirror_concurrency >= 1, f'镜像并发数至少为1, {mirror_concurrency=}')
+        self.mirror_limiter = asyncio.Semaphore(mirror_concurrency)
+        from httpx import URL
+        self.target_url = URL(self.target_base_url)
+        self.client = self.new_client(auth=self.target_auth)
+        self.target_repo_cache = {}
+        self.target_repo_tasks = {}
+        self.target_org_tasks = {}
+        cache_dir = raw_config['config'].get('cache_dir')
+        self.http_cache = HttpCache((Path(cache_dir).expanduser() if cache_dir else default_cache_dir()) / 'etags.json')
+        self.http_cache.load()
         self.mirrors = []
         for mirror in raw_config['mirrors']:
             mirror_obj = Mirror(
@@ -87,17 +171,41 @@ class Session:
             if mirror_obj.validate():
                 self.mirrors.append(mirror_obj)
 
-    async def check_token(self) -> bool:
-        # f'认证不成功, {resp.status_code=}'
-        if not token:
-            return False
-        self.target_client = AsyncClient(timeout=None, headers={
-            'Authorization': f'token {self.token}'
-        })
-        resp = await self.target_client.get(f"{self.target_base_url}/user")
+    def target_auth(self, request):
+        # 只给镜像站的请求加token，避免泄露给源站
+        # 比较规范化后的各部分，配置中host的大小写、显式的默认端口不影响匹配
+        url, target = request.url, self.target_url
+        if _url_origin(url) == _url_origin(target) and url.path.startswith(f"{target.path.rstrip('/')}/"):
+            request.headers['Authorization'] = f'token {self.token}'
+        return request
+
+    def new_client(self, **kwargs) -> AsyncClient:
+        # 默认连接池每个host只有少量连接，会让并发的migrate/分页请求排队
+        # 传输层对建立连接失败自动重试，状态码层面的重试见main._request
+        # httpx导入较慢，只在创建客户端时导入，--help或配置错误时不需要加载
+        from httpx import AsyncClient, AsyncHTTPTransport, Limits, Timeout
+        return AsyncClient(
+            timeout=Timeout(None, connect=10),
+            transport=AsyncHTTPTransport(
+                retries=3,
+                http2=True,
+                limits=Limits(
+                    max_connections=max(200, self.concurrency * 2),
+                    max_keepalive_connections=100,
+                    # migrate耗时较长，默认5秒的空闲过期会让连接在两次请求之间被关闭
+                    keepalive_expiry=30,
+                ),
+            ),
+            **kwargs
+        )
+
+    async def check_token(self):
+        resp = await self.client.get(f"{self.target_base_url}/user")
         if resp.status_code != 200:
-            return False
-        return True
+            raise RuntimeError(f'认证不成功, {resp.status_code=}')
+
+    async def aclose(self):
+        await self.client.aclose()
 
 
 session = Session()
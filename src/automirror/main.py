@@ -1,10 +1,18 @@
 # -*- coding: utf-8 -*-
-import argparse
 import logging
 import asyncio
+import random
+from operator import itemgetter
 from pathlib import Path
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
 from automirror.configs import session, MirrorType
 
+try:
+    # 可选依赖，解析大的分页列表时比标准库json快
+    import orjson
+except ImportError:
+    orjson = None
+
 __doc__ = """
 AutoMirror v0.1.0
 
@@ -14,6 +22,10 @@ AutoMirror v0.1.0
 target_base_url = "your_target_base_url" # 镜像站api
 origin_base_url = "your_origin_base_url" # 源站api Github: https://api.github.com
 token = "your_token" # 镜像站api访问的access token
+# concurrency = 3 # 同时存在的最大migrate任务数，默认为3
+# delete_concurrency = 5 # 同时存在的最大删除任务数，默认为5
+# mirror_concurrency = 5 # 同时同步的最大镜像数，默认为5
+# cache_dir = "~/.cache/automirror" # 列表请求的缓存目录，默认为 ~/.cache/automirror
 
 [[mirrors]]
 type = "org" # 源为Org
@@ -28,142 +40,422 @@ target = "your_target_org_name" # 同步到镜像站后属于的Org
 --- --- ---
 """.strip()
 
-parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter, description=__doc__)
-parser.add_argument('-c', '--config', type=Path, default=Path('./config.toml'), help='同步用配置文件路径')
+DEFAULT_CONFIG = Path('./config.toml')
 
 
-# TODO: 统一logging风格
+def build_parser():
+    import argparse
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter, description=__doc__)
+    parser.add_argument('-c', '--config', type=Path, default=DEFAULT_CONFIG, help='同步用配置文件路径')
+    return parser
 
-async def check_target(target) -> list[dict[str, str]]:
-    # 检查target是否存在
-    resp = await session.target_client.get(f'{session.target_base_url}/orgs/{target}')
-    assert resp.status_code in [200, 404], f'出了点小问题？{target=}, {resp.status_code=}'
-    target_repos = []
-    if resp.status_code == 404:
-        # 创建org
-        resp = await session.target_client.post(f'{session.target_base_url}/orgs/', json={'username': target})
-        assert resp.status_code == 201, f'创建org失败, {resp.status_code=}'
-    else:
-        target_repos = await get_target_org_repos(target)
-    return target_repos
-
-
-async def get_target_org_repos(target):
-    repos = []
-    url = f'{session.target_base_url}/orgs/{target}/repos'
-    while url:
-        resp = await session.target_client.get(url)
-        assert resp.status_code == 200, f'获取target_org失败, {resp.status_code=}'
-        repos.extend(resp.json())
-        if 'next' in resp.links:
-            url = resp.links['next'].get('url')
-        else:
-            url = None
-    return repos
+
+def parse_config_path(argv) -> Path:
+    # 常见的调用方式手动解析，避免导入argparse；--help等其他情况交给argparse处理
+    if not argv:
+        return DEFAULT_CONFIG
+    if len(argv) == 2 and argv[0] in ('-c', '--config'):
+        return Path(argv[1])
+    return build_parser().parse_args(argv).config
+
+
+RETRY_TIMES = 5
+PAGE_CONCURRENCY = 8
+# 网关类错误和限流视为临时错误，500通常是请求本身的问题，不重试
+RETRY_STATUS = {429, 502, 503, 504}
+# 非幂等的POST只在请求确定未被处理时重试，502/504时服务端可能仍在执行(如migrate仍在clone)
+POST_RETRY_STATUS = {429, 503}
+# 读超时、连接被断开(如HTTP/2的GOAWAY)时无法确定服务端是否已处理，只重发幂等的请求
+IDEMPOTENT_METHODS = {'GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS'}
+
+
+async def _request(method, url, *, limiter=None, retry_status=RETRY_STATUS, **kwargs):
+    """
+    发送请求，遇到临时错误时指数退避重试，429时优先使用Retry-After
+
+    幂等的请求遇到连接层错误(httpx.TransportError)时同样重试，重试次数用完后抛出
+
+    传入limiter时，429会让其并发上限减半，成功后逐步恢复到初始的并发上限
+    """
+    from httpx import TransportError
+    for attempt in range(RETRY_TIMES):
+        delay = 2 ** attempt / 2 + random.random()
+        try:
+            resp = await session.client.request(method, url, **kwargs)
+        except TransportError as e:
+            if method not in IDEMPOTENT_METHODS or attempt == RETRY_TIMES - 1:
+                raise
+            logging.warning('Retrying - %s %s - %r - %.1fs', method, url, e, delay)
+            await asyncio.sleep(delay)
+            continue
+        if resp.status_code not in retry_status:
+            if limiter is not None and resp.is_success and limiter.limit < limiter.max_limit:
+                await limiter.set_limit(limiter.limit + 1)
+            return resp
+        if attempt == RETRY_TIMES - 1:
+            return resp
+        if resp.status_code == 429:
+            if limiter is not None:
+                await limiter.set_limit(max(1, limiter.limit // 2))
+            try:
+                delay = float(resp.headers.get('Retry-After', delay))
+            except ValueError:
+                pass
+        logging.warning('Retrying - %s %s - resp.status_code=%s - %.1fs', method, url, resp.status_code, delay)
+        await asyncio.sleep(delay)
+
+
+def _expect(resp, ok, message):
+    if resp.status_code not in ok:
+        raise RuntimeError(f'{message}, {resp.status_code=}')
+
+
+def _once(tasks, key, func):
+    # 同一个key只运行一次func，并发的调用方等待同一个任务，失败时也共享同一个异常
+    task = tasks.get(key)
+    if task is None:
+        task = tasks[key] = asyncio.ensure_future(func(key))
+    # shield避免某个调用方被取消时连带取消共享的任务
+    return asyncio.shield(task)
+
+
+async def create_org_if_missing(target) -> bool:
+    # 检查target是否存在，不存在则创建，返回是否为新创建的
+    resp = await _request('GET', f'{session.target_base_url}/orgs/{target}')
+    _expect(resp, (200, 404), f'出了点小问题？{target=}')
+    if resp.status_code == 200:
+        return False
+    # 创建org
+    resp = await _request(
+        'POST', session.create_org_url, **_json_body({'username': target}), retry_status=POST_RETRY_STATUS
+    )
+    _expect(resp, (201,), '创建org失败')
+    return True
+
+
+async def ensure_org(target) -> bool:
+    return await _once(session.target_org_tasks, target, create_org_if_missing)
+
+
+async def check_target(target) -> set[str]:
+    if await ensure_org(target):
+        # 新创建的org没有仓库
+        return set()
+    return set(await get_target_org_repo_names(target))
+
+
+async def list_target_repo_names(target) -> set[str]:
+    session.target_repo_cache[target] = await check_target(target)
+    return session.target_repo_cache[target]
+
+
+async def get_target_repo_names(target) -> set[str]:
+    return await _once(session.target_repo_tasks, target, list_target_repo_names)
+
+
+def _json(resp):
+    if orjson is None:
+        return resp.json()
+    return orjson.loads(resp.content)
+
+
+_JSON_HEADERS = {'Content-Type': 'application/json'}
+
+
+def _json_body(data):
+    # 请求体参数，有orjson时自行编码，跳过httpx中的标准库json
+    if orjson is None:
+        return {'json': data}
+    return {'content': orjson.dumps(data), 'headers': _JSON_HEADERS}
+
+
+def _page_url(url, page):
+    # 替换url中的page参数，保留其他参数
+    parts = urlsplit(url)
+    query = [(k, v) for k, v in parse_qsl(parts.query) if k != 'page']
+    query.append(('page', page))
+    return urlunsplit(parts._replace(query=urlencode(query)))
+
+
+async def get_page(url, error_msg, project=None, with_links=True):
+    # ETag只覆盖当前页的内容，不覆盖分页信息(Link/X-Total-Count)，需要分页链接的页总是完整请求，
+    # 否则列表变长时会沿用旧的last链接漏掉新增的页，进而误删镜像
+    # 按页码获取的页使用条件请求，304时使用上次运行缓存的内容；不提供ETag的服务端退回到Last-Modified
+    key = str(url)
+    cached = None if with_links else session.http_cache.get(key)
+    headers = {}
+    if cached and cached.get('etag'):
+        headers['If-None-Match'] = cached['etag']
+    if cached and cached.get('last_modified'):
+        headers['If-Modified-Since'] = cached['last_modified']
+    resp = await _request('GET', url, headers=headers)
+    if resp.status_code == 304 and cached:
+        return cached['items'], {}
+    _expect(resp, (200,), error_msg)
+    # 已知总页数时后续页的Link头用不到，跳过解析
+    items, links = _json(resp), resp.links if with_links else {}
+    total = resp.headers.get('X-Total-Count')
+    if 'next' in links and 'last' not in links and total and items:
+        # 没有last链接但有X-Total-Count(Gitea/Forgejo)时，按当前页大小推算出最后一页
+        last_url = _page_url(links['next']['url'], -(-int(total) // len(items)))
+        links = {**links, 'last': {'url': last_url, 'rel': 'last'}}
+    if project is not None:
+        # 只保留需要的字段，减少内存占用和缓存体积
+        items = [project(item) for item in items]
+    etag, last_modified = resp.headers.get('ETag'), resp.headers.get('Last-Modified')
+    if not with_links and (etag or last_modified):
+        session.http_cache.set(key, {'etag': etag, 'last_modified': last_modified, 'items': items})
+    return items, links
+
+
+def _last_page(links):
+    # 从last链接中取出总页数，取不到时返回None，由调用方退回到逐页获取，不能当作只有一页而漏掉仓库
+    if 'last' not in links:
+        return None
+    page = dict(parse_qsl(urlsplit(links['last']['url']).query)).get('page')
+    try:
+        return int(page)
+    except (TypeError, ValueError):
+        return None
+
+
+async def iter_pages(url, error_msg, project=None):
+    # 逐页产出列表内容，调用方处理当前页时后续页已经在请求中
+    items, links = await get_page(url, error_msg, project)
+    pending = []
+    try:
+        last_page = _last_page(links)
+        if last_page is not None:
+            # 有last链接时一次性发出剩余所有页的请求
+            last_url = links['last']['url']
+            # 限制单个列表同时请求的页数，避免触发源站的限流
+            semaphore = asyncio.Semaphore(PAGE_CONCURRENCY)
+
+            async def get_nth_page(page):
+                async with semaphore:
+                    return await get_page(_page_url(last_url, page), error_msg, project, with_links=False)
+
+            pending = [asyncio.ensure_future(get_nth_page(page)) for page in range(2, last_page + 1)]
+            yield items
+            for task in pending:
+                items, _ = await task
+                yield items
+            return
+        # 没有可用的last链接时只能沿next链接逐页获取，先发出下一页的请求再产出当前页
+        while 'next' in links:
+            pending = [asyncio.ensure_future(get_page(links['next']['url'], error_msg, project))]
+            yield items
+            items, links = await pending[0]
+        yield items
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def get_all_pages(url, error_msg, project=None):
+    items = []
+    async for page in iter_pages(url, error_msg, project):
+        items.extend(page)
+    return items
+
+
+async def get_target_org_repo_names(target) -> list[str]:
+    return await get_all_pages(
+        f'{session.target_base_url}/orgs/{target}/repos', '获取target_org失败',
+        project=itemgetter('name')
+    )
+
+
+class Prefetch:
+    """立即开始获取异步迭代器的第一个元素，之后按原顺序继续迭代"""
+
+    def __init__(self, agen):
+        self._agen = agen
+        self._first = asyncio.ensure_future(anext(agen))
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._first is None:
+            return await anext(self._agen)
+        first, self._first = self._first, None
+        return await first
+
+    async def aclose(self):
+        if self._first is not None:
+            self._first.cancel()
+            await asyncio.gather(self._first, return_exceptions=True)
+            self._first = None
+        await self._agen.aclose()
+
+
+def _origin_repo_fields(repo):
+    # 源站每个仓库有上百个字段，同步只用到这两个
+    return {'name': repo['name'], 'clone_url': repo['clone_url']}
 
 
 async def get_origin_org_repos_iter(origin):
-    url = f'{session.origin_base_url}/orgs/{origin}/repos'
-    while url:
-        resp = await session.origin_client.get(url)
-        assert resp.status_code == 200, f'获取源org仓库失败, {resp.status_code=}'
-        for repo in resp.json():
+    async for page in iter_pages(
+            f'{session.origin_base_url}/orgs/{origin}/repos', '获取源org仓库失败',
+            project=_origin_repo_fields
+    ):
+        for repo in page:
             yield repo
-        if 'next' in resp.links:
-            url = resp.links['next'].get('url')
-        else:
-            url = None
 
 
 async def repo_migrate(clone_addr, repo_name, repo_owner):
+    from httpx import TransportError
     # 控制migrate并发数
-    async with session.semaphore:
-        resp = await session.target_client.post(
-            f'{session.target_base_url}/repos/migrate/',
-            json={
-                'clone_addr': clone_addr,
-                'mirror': True,
-                'repo_name': repo_name,
-                'repo_owner': repo_owner,
-            }
-        )
-        if resp.status_code == 201:
-            logging.info(f"Created - {repo_owner}/{repo_name}")
+    async with session.limiter:
+        try:
+            resp = await _request(
+                'POST',
+                session.migrate_url,
+                **_json_body({
+                    'clone_addr': clone_addr,
+                    'mirror': True,
+                    'repo_name': repo_name,
+                    'repo_owner': repo_owner,
+                }),
+                limiter=session.limiter,
+                retry_status=POST_RETRY_STATUS,
+            )
+        except TransportError as e:
+            # 只影响这一个仓库，不抛进TaskGroup连带取消同一org的其他任务
+            logging.error('CreateFailed - %s/%s - %r', repo_owner, repo_name, e)
             return
-        logging.error(f'CreateFailed - {repo_owner}/{repo_name} - {resp.status_code=}')
+    if resp.status_code == 201:
+        if repo_owner in session.target_repo_cache:
+            session.target_repo_cache[repo_owner].add(repo_name)
+        logging.info("Created - %s/%s", repo_owner, repo_name)
+        return
+    logging.error('CreateFailed - %s/%s - resp.status_code=%s', repo_owner, repo_name, resp.status_code)
     if resp.status_code == 422:
         # migrate失败，删除库
-        logging.error(f'Deleting - {repo_owner}/{repo_name} - {resp.status_code=}')
+        logging.error('Deleting - %s/%s - resp.status_code=%s', repo_owner, repo_name, resp.status_code)
         await repo_delete(repo_name, repo_owner)
 
 
 async def repo_delete(repo_name, repo_owner):
-    resp = await session.target_client.delete(f'{session.target_base_url}/repos/{repo_owner}/{repo_name}/')
+    from httpx import TransportError
+    # 删除使用单独的并发限制，不与migrate抢名额
+    async with session.delete_limiter:
+        try:
+            resp = await _request(
+                'DELETE',
+                f'{session.target_base_url}/repos/{repo_owner}/{repo_name}/',
+                limiter=session.delete_limiter,
+            )
+        except TransportError as e:
+            logging.error('DeleteFailed - %s/%s - %r', repo_owner, repo_name, e)
+            return
     if resp.status_code != 204:
-        logging.error(f'DeleteFailed - {repo_owner}/{repo_name} - {resp.status_code=}')
+        logging.error('DeleteFailed - %s/%s - resp.status_code=%s', repo_owner, repo_name, resp.status_code)
         return
-    logging.info(f"Deleted - {repo_owner}/{repo_name}")
+    if repo_owner in session.target_repo_cache:
+        session.target_repo_cache[repo_owner].discard(repo_name)
+    logging.info("Deleted - %s/%s", repo_owner, repo_name)
 
 
 async def update_org(mirror):
     get_origin_org_repos_exception = None
+    # 检查target的同时开始获取源仓库列表，两者访问不同的站点
+    origin_repos = Prefetch(get_origin_org_repos_iter(mirror.origin))
     try:
-        target_repos = await check_target(mirror.target)
-        target_repo_names = [x['name'] for x in target_repos]
+        # 复制一份，下面会从中剔除已存在的仓库
+        target_repo_names = set(await get_target_repo_names(mirror.target))
     except Exception as e:
-        logging.error(f'同步{mirror}失败：检查target时发生错误 {e}')
+        await origin_repos.aclose()
+        logging.error('同步%s失败：检查target时发生错误 %s', mirror, e)
         return
     async with asyncio.TaskGroup() as tg:
         try:
-            async for repo in get_origin_org_repos_iter(mirror.origin):
+            # 边获取源仓库列表边创建migrate任务
+            async for repo in origin_repos:
                 if repo['name'] in target_repo_names:
-                    target_repo_names.remove(repo['name'])
-                    logging.info(f"Existed - {mirror.target}/{repo['name']}")
+                    target_repo_names.discard(repo['name'])
+                    logging.info("Existed - %s/%s", mirror.target, repo['name'])
                 else:
                     tg.create_task(repo_migrate(repo['clone_url'], repo['name'], mirror.target))
         except Exception as e:
             get_origin_org_repos_exception = e
-        # 删除不存在的repo
-        for repo_name in target_repo_names:
-            tg.create_task(repo_delete(repo_name, mirror.target))
+        else:
+            # 删除不存在的repo，没有拿到完整的源仓库列表时不删除，避免误删
+            for repo_name in target_repo_names:
+                tg.create_task(repo_delete(repo_name, mirror.target))
+        finally:
+            # TaskGroup中途取消时也要关闭列表迭代器，取消已发出的分页请求
+            await origin_repos.aclose()
     if get_origin_org_repos_exception:
-        logging.error(f'同步{mirror}不完全：获取origin_repos时发生错误 {get_origin_org_repos_exception}')
+        logging.error('同步%s不完全：获取origin_repos时发生错误 %s', mirror, get_origin_org_repos_exception)
     else:
-        logging.info(f'同步{mirror}成功！')
+        logging.info('同步%s成功！', mirror)
 
 
 async def update_repo(mirror):
     try:
-        target_repos = await check_target(mirror.target)
-        target_repo_names = [x['name'] for x in target_repos]
+        # 直接查询单个仓库，不需要列出整个target
+        resp = await _request('GET', f'{session.target_base_url}/repos/{mirror.target}/{mirror.origin}')
+        _expect(resp, (200, 404), f'出了点小问题？{mirror.target=}')
+        if resp.status_code == 404:
+            await ensure_org(mirror.target)
     except Exception as e:
-        logging.error(f'同步{mirror}失败：检查target时发生错误 {e}')
+        logging.error('同步%s失败：检查target时发生错误 %s', mirror, e)
         return
-    # TODO: 避免获取全部target_repo再进行检查
-    if mirror.origin in target_repo_names:
-        logging.info(f"Existed - {mirror.target}/{mirror.origin}")
+    if resp.status_code == 200:
+        logging.info("Existed - %s/%s", mirror.target, mirror.origin)
     else:
         await repo_migrate(mirror.url, mirror.origin, mirror.target)
-    logging.info(f'同步{mirror}成功！')
+    logging.info('同步%s成功！', mirror)
+
+
+_HANDLERS = {
+    MirrorType.REPO: update_repo,
+    MirrorType.ORG: update_org,
+}
+
+
+async def dispatch(mirror):
+    handler = _HANDLERS.get(mirror.type)
+    if handler is None:
+        logging.warning('%s的类型没有对应的同步方式，将跳过同步', mirror)
+        return
+    # 限制同时同步的镜像数，避免大量列表请求同时打到源站
+    async with session.mirror_limiter:
+        logging.info('开始同步%s...', mirror)
+        try:
+            await handler(mirror)
+        except Exception as e:
+            # 单个镜像失败不影响其他镜像
+            logging.error('同步%s失败：%s', mirror, e)
 
 
 async def main(argv):
     # 关闭httpx的输出
     logging.getLogger("httpx").setLevel(logging.CRITICAL + 1)
     # 解析参数
-    args = parser.parse_args(argv)
-    session.load_config(args.config)
-    await session.check_token()
-    logging.info("开始同步")
-    for mirror in session.mirrors:
-        logging.info(f"开始同步{mirror}...")
-        if mirror.type == MirrorType.REPO:
-            await update_repo(mirror)
-        elif mirror.type == MirrorType.ORG:
-            await update_org(mirror)
+    config_path = parse_config_path(argv)
+    # 读取配置、缓存和创建客户端(加载证书)都是阻塞操作，放到线程中执行
+    await asyncio.to_thread(session.load_config, config_path)
+    completed = False
+    try:
+        await session.check_token()
+        logging.info("开始同步")
+        # 各镜像之间互不依赖，并发同步；同时进行的镜像数由session.mirror_limiter控制
+        async with asyncio.TaskGroup() as tg:
+            for mirror in session.mirrors:
+                tg.create_task(dispatch(mirror))
+        completed = True
+    finally:
+        # 提前失败时没有用到任何缓存条目，不能据此清理缓存
+        session.http_cache.save(prune=completed)
+        # 关闭连接池，避免退出时连接未释放
+        await session.aclose()
 
 
 if __name__ == '__main__':
-    import sys
+    # 与命令行入口一致，可用时使用uvloop
+    from automirror import entry
 
-    asyncio.run(main(sys.argv[1:]))
+    entry()
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import tempfile
+import unittest
+from pathlib import Path
+
+import httpx
+
+from automirror.configs import session
+
+
+class TargetAuthTest(unittest.TestCase):
+    def load(self, target_base_url, origin_base_url='https://api.github.com'):
+        with tempfile.TemporaryDirectory() as tmp:
+            config_path = Path(tmp) / 'config.toml'
+            config_path.write_text(f'''
+[config]
+target_base_url = "{target_base_url}"
+origin_base_url = "{origin_base_url}"
+token = "secret"
+cache_dir = "{Path(tmp).as_posix()}"
+
+[[mirrors]]
+type = "org"
+origin = "org"
+''', encoding='utf-8')
+            session.load_config(config_path)
+
+    def authorized(self, urls):
+        # 通过客户端实际发出请求，返回每个url是否带上了token
+        seen = {}
+
+        def handler(request: httpx.Request):
+            seen[str(request.url)] = request.headers.get('Authorization')
+            return httpx.Response(200)
+
+        async def run():
+            async with httpx.AsyncClient(transport=httpx.MockTransport(handler), auth=session.target_auth) as client:
+                for url in urls:
+                    await client.get(url)
+
+        asyncio.run(run())
+        return [seen[str(httpx.URL(url))] == 'token secret' for url in urls]
+
+    def test_target_requests_are_authorized(self):
+        for base in ('https://gitea.example.com/api/v1', 'HTTPS://Gitea.Example.com:443/api/v1', 'https://gitea.example.com/api/v1/'):
+            with self.subTest(base=base):
+                self.load(base)
+                self.assertEqual(self.authorized([
+                    f'{session.target_base_url}/user',
+                    'https://gitea.example.com/api/v1/repos/migrate/',
+                ]), [True, True])
+
+    def test_origin_requests_are_not_authorized(self):
+        self.load('HTTPS://Gitea.Example.com:443/api/v1')
+        self.assertEqual(self.authorized([
+            f'{session.origin_base_url}/orgs/org/repos',
+            'http://gitea.example.com/api/v1/user',
+            'https://gitea.example.com:3000/api/v1/user',
+        ]), [False, False, False])
+
+    def test_same_host_outside_api_prefix_is_not_authorized(self):
+        self.load('https://gitea.example.com/api/v1', origin_base_url='https://gitea.example.com/origin')
+        self.assertEqual(self.authorized([
+            f'{session.origin_base_url}/orgs/org/repos',
+            'https://gitea.example.com/api/v10/user',
+            'https://gitea.example.com/user/login',
+        ]), [False, False, False])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import hashlib
+import json
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+import httpx
+
+from automirror.cache import HttpCache
+from automirror.configs import session
+
+main = sys.modules['automirror.main']
+
+ORIGIN = 'https://origin.example.com'
+PER_PAGE = 2
+
+
+class OriginOrg:
+    """模拟源站的org仓库列表，带ETag和Link分页，304响应不带Link头"""
+
+    def __init__(self, names, total_count=False, last_without_page=False):
+        self.names = names
+        self.total_count = total_count
+        self.last_without_page = last_without_page
+        self.requests = []
+
+    def handler(self, request: httpx.Request):
+        self.requests.append(request)
+        page = int(request.url.params.get('page', 1))
+        pages = -(-len(self.names) // PER_PAGE)
+        body = json.dumps([
+            {'name': name, 'clone_url': f'{ORIGIN}/org/{name}.git'}
+            for name in self.names[(page - 1) * PER_PAGE:page * PER_PAGE]
+        ]).encode()
+        etag = '"%s"' % hashlib.md5(body).hexdigest()
+        if request.headers.get('If-None-Match') == etag:
+            return httpx.Response(304, headers={'ETag': etag})
+        headers = {'ETag': etag}
+        links = []
+        if page < pages:
+            links.append(f'<{ORIGIN}/orgs/org/repos?page={page + 1}>; rel="next"')
+            if self.last_without_page:
+                links.append(f'<{ORIGIN}/orgs/org/repos?cursor=end>; rel="last"')
+            elif not self.total_count:
+                links.append(f'<{ORIGIN}/orgs/org/repos?page={pages}>; rel="last"')
+        if links:
+            headers['Link'] = ', '.join(links)
+        if self.total_count:
+            headers['X-Total-Count'] = str(len(self.names))
+        return httpx.Response(200, content=body, headers=headers)
+
+
+class GetAllPagesTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cache_path = Path(self.tmp.name) / 'etags.json'
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def list_names(self, origin):
+        # 每次调用模拟一次独立的运行：从文件加载缓存，结束时保存
+        async def run():
+            session.client = httpx.AsyncClient(transport=httpx.MockTransport(origin.handler))
+            session.http_cache = HttpCache(self.cache_path)
+            session.http_cache.load()
+            try:
+                repos = await main.get_all_pages(
+                    f'{ORIGIN}/orgs/org/repos', '获取源org仓库失败', project=main._origin_repo_fields
+                )
+            finally:
+                session.http_cache.save()
+                await session.client.aclose()
+            return [repo['name'] for repo in repos]
+
+        return asyncio.run(run())
+
+    def test_unchanged_listing_uses_cache(self):
+        origin = OriginOrg(['a', 'b', 'c', 'd', 'e'])
+        self.assertEqual(self.list_names(origin), ['a', 'b', 'c', 'd', 'e'])
+        origin.requests.clear()
+        self.assertEqual(self.list_names(origin), ['a', 'b', 'c', 'd', 'e'])
+        # 第一页需要分页链接，总是完整请求；后续页使用条件请求
+        self.assertNotIn('If-None-Match', origin.requests[0].headers)
+        self.assertTrue(all('If-None-Match' in request.headers for request in origin.requests[1:]))
+
+    def test_grown_listing_with_unchanged_first_page(self):
+        # 第一页内容不变但列表多出一页，不能沿用上次的last链接
+        self.assertEqual(self.list_names(OriginOrg(['a', 'b', 'c', 'd'])), ['a', 'b', 'c', 'd'])
+        self.assertEqual(self.list_names(OriginOrg(['a', 'b', 'c', 'X', 'd'])), ['a', 'b', 'c', 'X', 'd'])
+
+    def test_grown_listing_with_total_count(self):
+        self.assertEqual(self.list_names(OriginOrg(['a', 'b', 'c', 'd'], total_count=True)), ['a', 'b', 'c', 'd'])
+        self.assertEqual(
+            self.list_names(OriginOrg(['a', 'b', 'c', 'X', 'd'], total_count=True)), ['a', 'b', 'c', 'X', 'd']
+        )
+
+    def test_last_link_without_page(self):
+        # last链接里没有page参数时沿next链接获取，不能当作只有一页
+        origin = OriginOrg(['a', 'b', 'c', 'd', 'e'], last_without_page=True)
+        self.assertEqual(self.list_names(origin), ['a', 'b', 'c', 'd', 'e'])
+
+
+class HttpCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = Path(self.tmp.name) / 'etags.json'
+        self.path.write_text(json.dumps({'u1': {'etag': '"1"'}, 'u2': {'etag': '"2"'}}))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_save_without_prune_keeps_entries(self):
+        cache = HttpCache(self.path)
+        cache.load()
+        cache.save(prune=False)
+        self.assertEqual(set(json.loads(self.path.read_text())), {'u1', 'u2'})
+
+    def test_save_prunes_unused_entries(self):
+        cache = HttpCache(self.path)
+        cache.load()
+        cache.get('u1')
+        cache.save()
+        self.assertEqual(set(json.loads(self.path.read_text())), {'u1'})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import json
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+import httpx
+
+from automirror.configs import Mirror, MirrorType, session
+
+main = sys.modules['automirror.main']
+
+TARGET = 'https://gitea.example.com/api/v1'
+ORIGIN = 'https://origin.example.com'
+
+
+class FakeSites:
+    """模拟源站和镜像站，flaky中的(method, path)第一次请求时抛出ReadError"""
+
+    def __init__(self, origin_names, target_names, flaky=(), broken_migrate=()):
+        self.origin_names = origin_names
+        self.target_names = target_names
+        self.flaky = set(flaky)
+        self.broken_migrate = set(broken_migrate)
+        self.created = []
+        self.deleted = []
+
+    def handler(self, request: httpx.Request):
+        key = (request.method, request.url.path)
+        if key in self.flaky:
+            self.flaky.discard(key)
+            raise httpx.ReadError('connection reset', request=request)
+        if request.url.host == 'origin.example.com':
+            return httpx.Response(200, json=[
+                {'name': name, 'clone_url': f'{ORIGIN}/org/{name}.git'} for name in self.origin_names
+            ])
+        path = request.url.path.removeprefix('/api/v1')
+        if request.method == 'GET' and path == '/orgs/t':
+            return httpx.Response(200, json={})
+        if request.method == 'GET' and path == '/orgs/t/repos':
+            return httpx.Response(200, json=[{'name': name} for name in self.target_names])
+        if request.method == 'POST' and path == '/repos/migrate/':
+            repo_name = json.loads(request.content)['repo_name']
+            if repo_name in self.broken_migrate:
+                raise httpx.ReadError('connection reset', request=request)
+            self.created.append(repo_name)
+            return httpx.Response(201, json={})
+        if request.method == 'DELETE':
+            self.deleted.append(path.split('/')[3])
+            return httpx.Response(204)
+        return httpx.Response(404)
+
+
+class UpdateOrgTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        config_path = Path(self.tmp.name) / 'config.toml'
+        config_path.write_text(f'''
+[config]
+target_base_url = "{TARGET}"
+origin_base_url = "{ORIGIN}"
+token = "secret"
+cache_dir = "{Path(self.tmp.name).as_posix()}"
+
+[[mirrors]]
+type = "org"
+origin = "org"
+target = "t"
+''', encoding='utf-8')
+        session.load_config(config_path)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def update_org(self, sites):
+        async def run():
+            session.client = httpx.AsyncClient(transport=httpx.MockTransport(sites.handler), auth=session.target_auth)
+            try:
+                await main.update_org(Mirror(type=MirrorType.ORG, origin='org', target='t'))
+            finally:
+                await session.aclose()
+
+        # 跳过重试前的退避等待
+        with mock.patch('asyncio.sleep', new=mock.AsyncMock()):
+            asyncio.run(run())
+
+    def test_migrate_transport_error_only_fails_that_repo(self):
+        sites = FakeSites(['a', 'b', 'c', 'd'], ['old'], broken_migrate={'b'})
+        with self.assertLogs(level='ERROR') as logs:
+            self.update_org(sites)
+        self.assertEqual(sorted(sites.created), ['a', 'c', 'd'])
+        self.assertEqual(sites.deleted, ['old'])
+        self.assertTrue(any('CreateFailed - t/b' in line for line in logs.output))
+
+    def test_idempotent_requests_retry_transport_errors(self):
+        sites = FakeSites(['a', 'b'], ['old'], flaky={
+            ('GET', '/orgs/org/repos'),
+            ('DELETE', '/api/v1/repos/t/old/'),
+        })
+        with self.assertLogs(level='WARNING') as logs:
+            self.update_org(sites)
+        self.assertEqual(sorted(sites.created), ['a', 'b'])
+        self.assertEqual(sites.deleted, ['old'])
+        self.assertEqual(sum('Retrying' in line for line in logs.output), 2)
+
+    def test_post_is_not_resent_after_transport_error(self):
+        sites = FakeSites(['a'], [], flaky={('POST', '/api/v1/repos/migrate/')})
+        with self.assertLogs(level='ERROR'):
+            self.update_org(sites)
+        self.assertEqual(sites.created, [])
+
+
+if __name__ == '__main__':
+    unittest.main()